@@ -2,13 +2,22 @@
 import os
 import sys
 import getopt
-import hashlib
 import time
-import platform
 import logging
+import atexit
+import uuid
 import subprocess
 import glob
-from datetime import datetime
+import fnmatch
+import re
+import shlex
+import ctypes
+import select
+try:
+	import fcntl
+except ImportError:
+	# Not available outside of Unix; fall back to legacy exclusive-create locks
+	fcntl = None
 
 PROGNAME = os.path.basename(sys.argv[0])
 VERSION = "%s v0.3.0" % PROGNAME
@@ -39,10 +48,18 @@ without a need to restart it:
 - rerun a job by deleting its `worker.lock` file.
 
 Multiple workers may be run on the same set of `pattern` arguments to achieve
-parallel processing. Race conditions are avoided via the `worker.lock` file,
-which is created using exclusive "x" file access mode. Only the worker which
-successfully creates the file may claim responsibility for the job. Exclusive
-file creation requires Python 3.3 or higher.
+parallel processing. Race conditions are avoided via the `worker.lock` file.
+By default a worker claims a job by taking a POSIX record lock on the
+lockfile, which it holds while the job runs; the kernel releases the lock
+automatically if the worker dies. A lockfile which already has contents marks
+a job that was claimed previously. Therefore, to remove a job, place a
+non-empty `worker.lock` file in its folder. With `--legacy-locks`, a claim is
+instead the exclusive creation of the lockfile ("x" file access mode), as in
+older versions of this script. With `--link-locks`, the claim is made by
+linking a temp file into place; link() fails atomically even on NFS
+implementations where exclusive creation is not reliable, making this the
+safest choice for studies on shared NFS storage. Workers using different
+locking schemes should not be pointed at the same study.
 
 A 'pattern' is interpreted as a Python glob, which is similar to the syntax in
 the Unix shell. See <https://docs.python.org/3/library/glob.html>.  When
@@ -50,160 +67,532 @@ passing a `pattern` argument, you may need to protect it from being expanded by
 your shell. For example, in Bash, wrap the pattern with single quotes.
 
 Usage: %s [-v] [-h] -p <pattern> [-p <pattern2> ...] -c <cmd>
-           [--maxjobs=<maxjobs>] [--maxhours=<maxhours>] [--label=<label>]
+           [--jobs=<jobs>] [--claim-batch=<batch>] [--watch] [--merge-output]
+           [--maxjobs=<maxjobs>]
+           [--maxhours=<maxhours>] [--label=<label>] [--legacy-locks]
+           [--link-locks]
 	-v or --version   print the version and exit
 	-h or --help      print usage and exit
 	-p or --pattern   include pattern in the list of patterns
 	-c or --cmd       command to launch each job
+	--jobs            max # of jobs to run concurrently (default: 1)
+	--claim-batch     # of job folders to claim per burst before launching
+	                  them (default: 1). Larger bursts amortize the scan work
+	                  across several executions when jobs are short
+	--watch           wait for new work instead of exiting when none is found.
+	                  Uses inotify where available (Linux); elsewhere the
+	                  worker sleeps between passes
+	--merge-output    write each job's stderr into its .out file instead of a
+	                  separate .err file
 	--maxjobs         max # of jobs to run (default: unlimited)
 	--maxhours        max # of hours to run, can be floating point (default: unlimited)
 	--label           prefix to use for lock file and log file names (default: worker)
+	--legacy-locks    claim jobs by exclusive lockfile creation rather than
+	                  POSIX record locks
+	--link-locks      claim jobs by linking a temp file into place; safest
+	                  on shared NFS storage
 """ % PROGNAME
 
-# ---- Begin parsing command line args -----
-patterns = []
-cmd = []
-max_jobs = sys.maxsize
-max_hours = float('inf')
-label = "worker"
-
-longopts = ["version", "help", "pattern=", "cmd=", "maxjobs=",
-	"maxhours=", "label="]
-options, arguments = getopt.getopt(
-	sys.argv[1:], # Arguments
-	'vh:p:c:',   # Short option definitions
-	longopts)     # Long option definitions
-for o, a in options:
-	if o in ("-v", "--version"):
-		print(VERSION)
-		sys.exit()
-	if o in ("-h", "--help"):
-		print(VERSION)
-		print(USAGE)
-		sys.exit()
-	if o in ("-p", "--pattern"):
-		patterns.append(a)
-	if o in ("-c", "--cmd"):
-		# We need present the command as a list of tokens later when we
-		# invoke it with subprocess. This might not be the most robust way
-		# to take the input, but let's see how well it works.
-		for tok in a.split(' '):
-			cmd.append(tok)
-	if o in ("--maxjobs"):
-		max_jobs = int(a)
-	if o in ("--maxhours"):
-		max_hours = float(a)
-	if o in ("--label"):
-		label = a
-try:
-	operands = [int(arg) for arg in arguments]
-except ValueError:
-	raise SystemExit(USAGE)
-if len(patterns) == 0:
-	print("Must provide at least one pattern. Use -h for help")
-	exit(1)
-if len(cmd) == 0:
-	print("Must provide a command. Use -h for help")
-	exit(1)
-# ---- End parsing command line args -----
-
-# Take now to be the starting time
-start_time = datetime.now()
-elapsed_hours = 0
-
-# Set up logging
-logging.basicConfig(
-	stream = sys.stdout,
-	format = '%(asctime)s - %(message)s',
-	level = logging.INFO,
-	datefmt = '%Y-%m-%d %H:%M:%S')
-
-# Create a hash that represents a (somewhat) unique ID for this run
-# Use hostname with time appended
-str2hash = platform.node() + str(time.time())
-result = hashlib.md5(str2hash.encode())
-worker_id = result.hexdigest()
-logging.info("Worker ID: %s" % worker_id)
-
-# Get the current working directory
-cwd = os.getcwd()
-logging.info("Working directory: %s" % cwd)
-
-L = len(patterns)
-
-keep_looping = True
-processed_jobs = 0
-
-# ----- Finally, start the main loop -----
-while keep_looping:
-	# We will stop looping only if we make a full pass without finding any new
-	# work. This allows the user to add, remove, or rerun jobs without having to
-	# restart a running worker.
-	keep_looping = False
-	logging.info("Searching %d patterns for available work" % L)
-
-	for i in range(L):
-		pattern = patterns[i]
-		logging.info("Searching pattern[%d]: %s" % (i, pattern))
-
-		# Interpret the pattern as a glob to search for relevant files
-		for entry in glob.glob(pattern):
-			# Ignore entries that are not directories
-			if not os.path.isdir(entry):
-				logging.info("Entry %s is not a folder, ignoring" % entry)
+# Flags for opening a job folder itself, to use as a dir_fd anchor for the
+# files inside it. O_PATH (Linux) avoids granting read access we do not need
+DIR_FD_FLAGS = os.O_DIRECTORY | getattr(os, 'O_PATH', os.O_RDONLY)
+
+def split_literal_prefix(pattern):
+	"""
+	Split a glob `pattern` into a literal directory prefix and the remaining
+	wildcard-bearing portion. E.g. "runs/exp_*" becomes ("runs", "exp_*").
+	Only the portion after the prefix needs glob matching, so the prefix can
+	be handled with a single scan or stat rather than a walk.
+	"""
+	parts = pattern.split(os.path.sep)
+	head = []
+	while parts and not glob.has_magic(parts[0]):
+		head.append(parts.pop(0))
+	return (os.path.sep.join(head), os.path.sep.join(parts))
+
+def compile_pattern(pattern):
+	"""
+	Precompute matching state for a glob `pattern` as a tuple (prefix,
+	trailing, regex), where `prefix` is the literal directory prefix and
+	`regex` is the compiled form of the trailing wildcard segment - or None
+	when the pattern is fully literal and names a job folder directly. The
+	main loop revisits every pattern once per pass, so compiling here avoids
+	re-translating the pattern through fnmatch on each pass. Patterns with
+	wildcards spread across several segments return None altogether;
+	iter_job_dirs falls back to glob for those.
+	"""
+	prefix, rest = split_literal_prefix(pattern)
+	if not rest:
+		return (pattern, None, None)
+	if os.path.sep in rest:
+		return None
+	return (prefix, rest, re.compile(fnmatch.translate(rest)))
+
+def iter_job_dirs(pattern, compiled = None):
+	"""
+	Yield paths of directories which match the glob `pattern`. A result of
+	compile_pattern(pattern) may be passed as `compiled` to reuse work across
+	repeated scans.
+
+	When only the last segment of the pattern contains wildcards - the common
+	case for a study laid out as `base/job_*` - we can scan the literal prefix
+	directory once with os.scandir and filter entry names, rather than calling
+	glob. The DirEntry objects returned by scandir cache the entry type, so we
+	usually avoid making a separate stat call per entry; passing
+	follow_symlinks=False below keeps is_dir on that cached path even for
+	symlinks. A consequence is that symlinks to directories are not treated
+	as job folders, in any of the branches here.
+	"""
+	if compiled is None:
+		compiled = compile_pattern(pattern)
+	if compiled is None:
+		# Wildcards appear in more than the last segment (or the pattern
+		# ends with a separator); let glob handle these less common cases.
+		for path in glob.glob(pattern):
+			if os.path.isdir(path) and not os.path.islink(path):
+				yield path
+			else:
+				logging.debug("Entry %s is not a folder, ignoring", path)
+		return
+	prefix, trailing, regex = compiled
+	if regex is None:
+		# The pattern is fully literal, so one stat replaces the whole scan
+		if os.path.isdir(pattern) and not os.path.islink(pattern):
+			yield pattern
+		return
+	try:
+		it = os.scandir(prefix if prefix else os.curdir)
+	except (FileNotFoundError, NotADirectoryError):
+		return
+	with it:
+		for entry in it:
+			# Match glob's behavior of hiding dotfiles from wildcards
+			if entry.name.startswith('.') and not trailing.startswith('.'):
 				continue
-			subdir = entry
-
-			# Workers coordinate through the existence of this lockfile
-			lockfile = os.path.join(subdir + os.path.sep + "%s.lock" % label)
-
-			# Check if the lockfile exists. If so, we can ignore this folder
-			if os.path.isfile(lockfile):
-				logging.info("Lockfile in %s exists, skipping" % subdir)
+			if regex.match(entry.name) is None:
 				continue
-
-			# If we find at least one subdir without a lock, there might
-			# be more work to do. Set keep_looping to True
-			keep_looping = True
-
-			# There is no lockfile, so see if we can acquire it ourselves.
-			# If we can, leave our ID and close the lockfile before doing any
-			# actual work.
-			acquired_lock = False
-			try:
-				with open(lockfile, 'x') as f:
-					f.write("Reserved by worker: %s\n" % worker_id)
-					acquired_lock = True
-			except FileExistsError:
-				logging.warn("Could not lock: %s" % lockfile)
-
-			if acquired_lock:
-				logging.info("Lockfile in %s acquired" % subdir)
-
-				# Now change to the directory of the job
-				os.chdir(subdir)
-
-				# Run the job. Make sure to save stdout and stderr steams
-				with open("%s.out" % label, 'w') as g, open("%s.err" % label, 'w') as h:
-					subprocess.call(cmd, stdout = g, stderr = h)
-
-				# Increment the number of jobs we have processed
-				processed_jobs += 1
-
-				# Change back to the original current working directory
-				os.chdir(cwd)
-
-			elapsed_hours = (datetime.now() - start_time).total_seconds() / 60**2
-			logging.info("Processed %d jobs and worked for %f total hours so far" %
-				(processed_jobs, elapsed_hours))
-
-			if processed_jobs >= max_jobs:
-				logging.info("Reached limit of %d jobs" % max_jobs)
-				exit(0)
-
+			# Like glob, report paths relative to how the pattern was given
+			path = os.path.join(prefix, entry.name) if prefix else entry.name
+			if entry.is_dir(follow_symlinks = False):
+				yield path
+			else:
+				logging.debug("Entry %s is not a folder, ignoring", path)
+
+# inotify event flags (from <sys/inotify.h>); we care about entries being
+# created, moved in, or deleted in the folders we watch
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+
+def init_watches(patterns):
+	"""
+	Set up inotify watches on the literal prefix directory of each pattern,
+	so that watch mode can sleep until a folder or lockfile changes rather
+	than repeatedly rescanning. inotify is Linux-specific and is reached here
+	through libc; return None if it is unavailable, or if any pattern has
+	wildcards outside its last segment (we would not know which directories
+	to watch). The caller then falls back to sleeping between passes.
+	"""
+	dirs = set()
+	for pattern in patterns:
+		prefix, trailing = os.path.split(pattern)
+		if not trailing or glob.has_magic(prefix):
+			return None
+		dirs.add(prefix if prefix else os.curdir)
+	try:
+		libc = ctypes.CDLL(None, use_errno = True)
+		fd = libc.inotify_init()
+	except (OSError, AttributeError):
+		return None
+	if fd < 0:
+		return None
+	for d in dirs:
+		wd = libc.inotify_add_watch(fd, os.fsencode(d),
+			IN_CREATE | IN_MOVED_TO | IN_DELETE)
+		if wd < 0:
+			logging.info("Could not watch folder %s", d)
+	return fd
+
+def wait_for_changes(watch_fd, timeout):
+	"""
+	Block until one of the watched folders changes, or until `timeout`
+	seconds pass. The timeout also covers changes made inside job folders
+	(e.g. a deleted lockfile), which the watches on the parent folders do
+	not see. If inotify was unavailable, simply sleep for the timeout.
+	"""
+	if watch_fd is None:
+		time.sleep(timeout)
+		return
+	ready, _, _ = select.select([watch_fd], [], [], timeout)
+	if ready:
+		# Drain the queued events; the next pass rescans the patterns anyway
+		os.read(watch_fd, 65536)
+
+def claim_job(dfd, lock_name, tmp_lock_name, reserved_msg, lock_mode):
+	"""
+	Attempt to claim the job folder opened at `dfd` by taking its lockfile.
+	Returns an open lockfile fd if the claim succeeded and None otherwise;
+	the caller should close the fd once the job has finished.
+
+	Three schemes are supported through `lock_mode`. With "fcntl", the
+	default, the claim is protected by a POSIX record lock which is held for
+	the duration of the job. The kernel releases the lock automatically if
+	the worker dies, so a worker killed in the middle of claiming a job
+	cannot leave it permanently blocked, and live claims are visible with
+	e.g. lslocks. A lockfile which already has contents marks a job that was
+	claimed previously, as in the other schemes. With "legacy", the
+	exclusive creation of the lockfile is itself the entire claim, as in
+	older versions of this script. With "link", the lockfile contents are
+	first written to a uniquely named temp file which is then linked into
+	place; link() fails with EEXIST atomically even on NFS implementations
+	where exclusive creation historically was not atomic, so the first
+	worker whose link succeeds owns the claim.
+	"""
+	if lock_mode == "legacy":
+		try:
+			fd = os.open(lock_name,
+				os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644, dir_fd = dfd)
+		except FileExistsError:
+			return None
+		os.write(fd, reserved_msg)
+		return fd
+	if lock_mode == "link":
+		fd = os.open(tmp_lock_name,
+			os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644, dir_fd = dfd)
+		os.write(fd, reserved_msg)
+		try:
+			os.link(tmp_lock_name, lock_name,
+				src_dir_fd = dfd, dst_dir_fd = dfd)
+		except FileExistsError:
+			os.close(fd)
+			fd = None
+		finally:
+			# The temp name is no longer needed either way; a successful
+			# link leaves the lockfile name pointing at the same inode
+			os.unlink(tmp_lock_name, dir_fd = dfd)
+		return fd
+	fd = os.open(lock_name, os.O_CREAT | os.O_RDWR, 0o644, dir_fd = dfd)
+	try:
+		fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		# Another worker holds the record lock right now
+		os.close(fd)
+		return None
+	if os.fstat(fd).st_size > 0:
+		# The job was claimed before; closing the fd releases our lock
+		os.close(fd)
+		return None
+	os.write(fd, reserved_msg)
+	return fd
+
+def scan_and_claim(pattern: str, compiled, lock_name: str,
+		tmp_lock_name: str, reserved_msg: bytes, lock_mode: str,
+		seen_locked: set):
+	"""
+	Scan one pattern and yield a (subdir, dfd, lock_fd) tuple for each job
+	folder we manage to claim, in discovery order. The folder fd `dfd` is
+	left open so the caller can open the job's stream files relative to it;
+	`lock_fd` must stay open until the job has finished. Folders whose claim
+	attempt fails are added to `seen_locked` and skipped on later scans.
+
+	This is the hot loop of the worker, so it is kept self-contained with
+	everything it needs passed in; it could be compiled ahead of time (e.g.
+	with mypyc or Cython) without touching the rest of the script.
+	"""
+	for subdir in iter_job_dirs(pattern, compiled):
+		# Skip folders we already know to be locked
+		if subdir in seen_locked:
+			continue
+
+		# Open the job folder once and address the lockfile (and later the
+		# stream files) relative to it, so the kernel resolves the folder
+		# path a single time rather than once per file operation
+		dfd = os.open(subdir, DIR_FD_FLAGS)
+
+		# Attempt to claim the job through its lockfile; see claim_job for
+		# the two locking schemes
+		lock_fd = claim_job(dfd, lock_name, tmp_lock_name, reserved_msg,
+			lock_mode)
+		if lock_fd is None:
+			seen_locked.add(subdir)
+			logging.debug("Lockfile in %s exists, skipping", subdir)
+			os.close(dfd)
+			continue
+		seen_locked.add(subdir)
+		yield (subdir, dfd, lock_fd)
+
+def reap_finished(running):
+	"""
+	Poll the pool of running jobs and return only those still active. The
+	output streams and lockfile fd of any job which has finished are closed
+	here; closing the lockfile releases its record lock.
+	"""
+	still_running = []
+	for p, g, h, lock_fd, subdir in running:
+		if p.poll() is None:
+			still_running.append((p, g, h, lock_fd, subdir))
+		else:
+			g.close()
+			if h is not None:
+				h.close()
+			os.close(lock_fd)
+			logging.info("Job in %s finished with return code %d",
+				subdir, p.returncode)
+	return still_running
+
+def drain_jobs(running):
+	"""Wait for every job in the pool to finish."""
+	while running:
+		running = reap_finished(running)
+		if running:
+			time.sleep(0.1)
+
+def main():
+	# ---- Begin parsing command line args -----
+	patterns = []
+	cmd = []
+	n_jobs = 1
+	claim_batch = 1
+	watch = False
+	max_jobs = sys.maxsize
+	max_hours = float('inf')
+	label = "worker"
+	lock_mode = "fcntl"
+	merge_output = False
+
+	longopts = ["version", "help", "pattern=", "cmd=", "jobs=",
+		"claim-batch=", "watch", "merge-output", "maxjobs=", "maxhours=",
+		"label=", "legacy-locks", "link-locks"]
+	options, arguments = getopt.getopt(
+		sys.argv[1:], # Arguments
+		'vh:p:c:',   # Short option definitions
+		longopts)     # Long option definitions
+	for o, a in options:
+		if o in ("-v", "--version"):
+			print(VERSION)
+			sys.exit()
+		if o in ("-h", "--help"):
+			print(VERSION)
+			print(USAGE)
+			sys.exit()
+		if o in ("-p", "--pattern"):
+			patterns.append(a)
+		if o in ("-c", "--cmd"):
+			# We need to present the command as a list of tokens later when
+			# we invoke it with subprocess. Split it the way a shell would,
+			# so quoted arguments and escapes survive intact.
+			cmd.extend(shlex.split(a))
+		if o in ("--jobs"):
+			n_jobs = int(a)
+		if o in ("--claim-batch",):
+			claim_batch = int(a)
+		if o in ("--watch"):
+			watch = True
+		if o in ("--merge-output"):
+			merge_output = True
+		if o in ("--maxjobs"):
+			max_jobs = int(a)
+		if o in ("--maxhours"):
+			max_hours = float(a)
+		if o in ("--label"):
+			label = a
+		if o in ("--legacy-locks"):
+			lock_mode = "legacy"
+		if o in ("--link-locks"):
+			lock_mode = "link"
+	try:
+		operands = [int(arg) for arg in arguments]
+	except ValueError:
+		raise SystemExit(USAGE)
+	if len(patterns) == 0:
+		print("Must provide at least one pattern. Use -h for help")
+		exit(1)
+	if len(cmd) == 0:
+		print("Must provide a command. Use -h for help")
+		exit(1)
+	if n_jobs < 1:
+		print("Number of concurrent jobs must be at least 1. Use -h for help")
+		exit(1)
+	if claim_batch < 1:
+		print("Claim batch size must be at least 1. Use -h for help")
+		exit(1)
+	if fcntl is None and lock_mode == "fcntl":
+		# Record locks are unavailable on this platform
+		lock_mode = "legacy"
+	# ---- End parsing command line args -----
+
+	# Take now to be the starting time. The monotonic clock cannot jump with
+	# wall-clock adjustments, which could otherwise trip maxhours spuriously
+	start_time = time.monotonic()
+	elapsed_hours = 0
+
+	# Set up logging. Wrap stdout in a larger buffer so that a busy discovery
+	# pass does not flush a line per record, and register a flush at exit so no
+	# buffered records are lost
+	log_stream = open(sys.stdout.fileno(), 'w', buffering = 65536, closefd = False)
+	atexit.register(log_stream.flush)
+	logging.basicConfig(
+		stream = log_stream,
+		format = '%(asctime)s - %(message)s',
+		level = logging.INFO,
+		datefmt = '%Y-%m-%d %H:%M:%S')
+
+	# Create a unique ID for this run. A random UUID gives better uniqueness
+	# than hashing the hostname and time, and avoids depending on MD5, which
+	# may be unavailable on FIPS-restricted systems
+	worker_id = uuid.uuid4().hex
+	logging.info("Worker ID: %s", worker_id)
+
+	# Encode the lockfile contents once; it is the same for every job we claim
+	reserved_msg = ("Reserved by worker: %s\n" % worker_id).encode()
+
+	# Precompute the per-job file names, which depend only on the label, rather
+	# than formatting them again for every candidate folder
+	lock_name = "%s.lock" % label
+	out_name = "%s.out" % label
+	err_name = "%s.err" % label
+
+	# The temp name used by the link locking scheme; the worker ID keeps it
+	# unique among workers sharing a folder
+	tmp_lock_name = "%s.%s.tmp" % (lock_name, worker_id)
+
+	# Get the current working directory
+	cwd = os.getcwd()
+	logging.info("Working directory: %s", cwd)
+
+	L = len(patterns)
+
+	# Compile each pattern once up front; the main loop rescans them every pass
+	compiled = [compile_pattern(p) for p in patterns]
+
+	# In watch mode, set up filesystem watches so idle passes can block instead
+	# of spinning
+	watch_fd = init_watches(patterns) if watch else None
+	if watch and watch_fd is None:
+		logging.info("inotify unavailable, will sleep between passes instead")
+
+	keep_looping = True
+	processed_jobs = 0
+	pass_count = 0
+
+	# Pool of jobs which have been launched and not yet reaped. Each element is a
+	# tuple (Popen handle, stdout stream, stderr stream, lockfile fd, job folder)
+	running = []
+
+	# Folders we have already observed to be locked. A locked folder stays
+	# locked unless the user deletes its lockfile by hand, so later passes can
+	# skip these without touching the filesystem. The set is cleared
+	# periodically to pick up such manual deletions
+	seen_locked = set()
+
+	# ----- Finally, start the main loop -----
+	while keep_looping:
+		# We will stop looping only if we make a full pass without finding any new
+		# work. This allows the user to add, remove, or rerun jobs without having to
+		# restart a running worker.
+		keep_looping = False
+		pass_count += 1
+		if pass_count % 10 == 0:
+			seen_locked.clear()
+		logging.info("Searching %d patterns for available work", L)
+
+		for i in range(L):
+			pattern = patterns[i]
+			logging.info("Searching pattern[%d]: %s", i, pattern)
+
+			# Interpret the pattern as a glob and claim any open job folders.
+			# Claims are made in bursts of up to claim_batch folders, which
+			# are then launched together; a burst amortizes the scan work
+			# across several executions when jobs are short
+			scan = scan_and_claim(pattern, compiled[i], lock_name,
+				tmp_lock_name, reserved_msg, lock_mode, seen_locked)
+			while True:
+				# Never claim more jobs than maxjobs leaves us room to run;
+				# every claimed folder must be launched before we can exit
+				burst = min(claim_batch, max_jobs - processed_jobs)
+				claims = []
+				for claim in scan:
+					claims.append(claim)
+					if len(claims) >= burst:
+						break
+				if len(claims) == 0:
+					break
+
+				# We found subdirs whose locks we could acquire, so there
+				# might be more work to do afterward. Set keep_looping to True
+				keep_looping = True
+
+				for subdir, dfd, lock_fd in claims:
+					logging.info("Lockfile in %s acquired", subdir)
+					rel_opener = lambda name, flags: os.open(name, flags, dir_fd = dfd)
+
+					# Launch the job in its own folder via the cwd argument,
+					# so that the worker itself never changes directory;
+					# os.chdir is process-global and would be unsafe with
+					# concurrent jobs. Make sure to save stdout and stderr
+					# streams. With merge-output, stderr shares the stdout
+					# file and we skip opening a separate .err file
+					g = open(out_name, 'w', opener = rel_opener)
+					if merge_output:
+						h = None
+						p = subprocess.Popen(cmd, stdout = g,
+							stderr = subprocess.STDOUT, cwd = subdir)
+					else:
+						h = open(err_name, 'w', opener = rel_opener)
+						p = subprocess.Popen(cmd, stdout = g, stderr = h,
+							cwd = subdir)
+					running.append((p, g, h, lock_fd, subdir))
+
+					# The folder fd is no longer needed; the job itself runs
+					# with its own working directory via cwd above
+					os.close(dfd)
+
+					# Increment the number of jobs we have processed
+					processed_jobs += 1
+
+					# If the pool is full, wait here until a job finishes.
+					# With the default of one concurrent job, this runs each
+					# job to completion before launching the next, as before.
+					while len(running) >= n_jobs:
+						running = reap_finished(running)
+						if len(running) >= n_jobs:
+							time.sleep(0.1)
+
+				elapsed_hours = (time.monotonic() - start_time) / 3600.0
+				logging.info("Processed %d jobs and worked for %f total hours so far",
+					processed_jobs, elapsed_hours)
+
+				if processed_jobs >= max_jobs:
+					logging.info("Reached limit of %d jobs", max_jobs)
+					drain_jobs(running)
+					exit(0)
+
+				if elapsed_hours >= max_hours:
+					logging.info("Reached limit of %f hours", max_hours)
+					drain_jobs(running)
+					exit(0)
+
+		# In watch mode, an empty pass means we wait for the filesystem to
+		# change rather than exiting. The worker then runs until it reaches
+		# maxjobs or maxhours, or is interrupted. The maxhours check must be
+		# repeated here, since the check above only runs after claiming a
+		# job, and an idle worker would otherwise block forever
+		if not keep_looping and watch:
+			elapsed_hours = (time.monotonic() - start_time) / 3600.0
 			if elapsed_hours >= max_hours:
-				logging.info("Reached limit of %f hours" % max_hours)
+				logging.info("Reached limit of %f hours", max_hours)
+				drain_jobs(running)
 				exit(0)
+			logging.info("No available work found, waiting for changes")
+			# Cap the wait so we wake in time for the maxhours check even
+			# if nothing on the filesystem changes
+			timeout = min(60.0, (max_hours - elapsed_hours) * 3600.0)
+			wait_for_changes(watch_fd, timeout)
+			keep_looping = True
 
-logging.info("Done")
+	# Wait for any jobs which are still running before exiting
+	drain_jobs(running)
+	logging.info("Done")
 
+if __name__ == "__main__":
+	main()
@@ -223,18 +223,14 @@ do
 				echo "Reserved by worker: $worker_id" > $lockfile
 				logger "Lockfile in $subdir acquired"
 
-				# Change to the directory of the job
-				cd ${subdir}
-
-				# Run the job. Make sure to save stdout and stderr steams
-				$cmd 1>${label}.out 2>${label}.err
+				# Run the job in a subshell started in the job's folder, so
+				# the worker itself never has to change directory and change
+				# back. Make sure to save stdout and stderr streams
+				(cd ${subdir} && exec $cmd 1>${label}.out 2>${label}.err)
 
 				# Increment the number of jobs we have processed
 				((processed_jobs++))
 
-				# Change back to the home path
-				cd $cwd
-
 				# Release the lock
 				flock --unlock --nonblock 100
 			else